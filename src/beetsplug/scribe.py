@@ -1,7 +1,14 @@
+import json
+import os
 import re
+import socket
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass
 from beets import config
 from beets.plugins import BeetsPlugin
-from beets.ui import Subcommand, decargs, print_
+from beets.ui import Subcommand, UserError, decargs, print_
 from beets.dbcore import types
 from bs4 import BeautifulSoup
 import confuse
@@ -58,6 +65,13 @@ class ScribePlugin(BeetsPlugin):
             dest="quiet",
             help="decrease amount of information showed during activity",
         )
+        command.parser.add_option(
+            "-v",
+            "--verbose",
+            action="store_true",
+            dest="verbose",
+            help="show details for each work and item processed, instead of a periodic progress report",
+        )
         command.parser.add_option(
             "-g",
             "--genre",
@@ -100,32 +114,58 @@ class ScribePlugin(BeetsPlugin):
             dest="search",
             help="use the parameter's value as a google search string for a specific pair (composer, work); the resulting data will be applied to all items matching the beets query. User is responsible to pass a query in which all items belong to same pair (composer, work)",
         )
+        command.parser.add_option(
+            "-Q",
+            "--queue",
+            action="store",
+            dest="queue",
+            help="path of a shared work queue (SQLite file); pairs (composer, work) are published to the queue and only the results already resolved by a worker are applied to the items",
+        )
+        command.parser.add_option(
+            "-w",
+            "--worker",
+            action="store_true",
+            dest="worker",
+            help="worker mode, resolve the pairs (composer, work) pending on the queue and publish the results, without modifying the library",
+        )
         command.func = self.run
         return [command]
 
     def run(self, lib, opts, args):
         self.populate_cfg(opts)
+        o = self.options
 
-        if self.config["explain"].get(False):
+        if o.explain:
             explain()
             return
 
+        if o.worker:
+            self.run_worker()
+            return
+
+        if o.search and o.queue:
+            raise UserError(f"{self.name}: search mode can't be used with a queue")
+
         items = self.do_query(lib, decargs(args))
 
-        updated = 0
-        if self.config["search"].get(""):
-            updated += self.manual_search(items)
+        if o.search:
+            self.progress = self.new_progress(1, f"item(s) {o.action}")
+            self.manual_search(items)
         else:
             works = self.collect_works(items)
-            if self.config["list_works"].get(False):
+            if o.list_works:
                 for work in works:
                     print_(f'{work[0]}:"{work[1]}", work:"{work[2]}"')
                 return
-            for work in works:
-                updated += self.process_work(lib, work)
-        if not self.config["interactive"].get(False):
+            self.progress = self.new_progress(len(works), f"item(s) {o.action}")
+            if o.queue:
+                self.apply_queue(lib, works)
+            else:
+                for work in works:
+                    self.process_work(lib, work)
+        if not o.interactive and not o.queue:
             self.msg(f"{self.cs_call_count} google custom search call(s) executed")
-        self.msg(f"{updated} item(s) {self.config['action'].as_str()}")
+        self.msg(f"{self.progress.updated} item(s) {o.action}")
 
     def populate_cfg(self, opts):
         cfg = self.config
@@ -136,28 +176,30 @@ class ScribePlugin(BeetsPlugin):
         custom_search_list.get(cs_template)
         self.cs_last_call = [0 for _ in range(len(list(custom_search_list)))]
         self.cs_call_count = 0
-        cfg["action"].set(
-            "potentially updated" if cfg["pretend"].get(False) else "updated"
-        )
+        self.cs_last_status = 200
+        self.options = run_options(cfg)
 
     def do_query(self, lib, query):
-        force = self.config["force"].get(False)
+        force = self.options.force
         query = query if force else query + [WORK_STYLE + ":=~"]
         self._log.debug(f"query: {query}")
         items = lib.items(query)
-        if not self.config["quiet"].get(False):
+        if not self.options.quiet:
             print_(
                 f"found {len(items)} item(s) matching{'' if force else ', excluding items already populated' }"
             )
         return items
 
     def collect_works(self, items):
-        if not self.config["quiet"].get(False):
-            for item in items:
-                if not item["work"]:
-                    print_(
-                        f"item discarded, empty work field: {item['artist']} - {item['album']} - {item['title']}"
-                    )
+        discarded = 0
+        for item in items:
+            if not item["work"]:
+                discarded += 1
+                self.detail(
+                    f"item discarded, empty work field: {item['artist']} - {item['album']} - {item['title']}"
+                )
+        if discarded:
+            self.msg(f"{discarded} item(s) discarded, empty work field")
         works = {
             map_work(item)
             for item in items
@@ -168,64 +210,149 @@ class ScribePlugin(BeetsPlugin):
             f"found {len(works)} work(s) matching"
             + (
                 ""
-                if self.config["force"].get(False)
+                if self.options.force
                 else ", excluding works with items already populated"
             ),
         )
         return works
 
     def process_work(self, lib, work):
-        updated = 0
-        self.msg(
+        self.detail(
             f'\nprocess work: {work[0]}:"{work[1]}", work:"{work[2]}"',
         )
         res = self.find_data(f"{work[1]} {work[2]}")
+        updated = self.apply_work(lib, work, res)
+        self.progress.advance(updated)
+        return updated
+
+    def apply_work(self, lib, work, res):
+        updated = 0
         if res and res[WORK_STYLE]:
+            data = work_data(res, self.options)
             work_query = (
                 f"{work[0]}::^{re.escape(work[1])}",
                 f"work::^{re.escape(work[2])}(\\s*:.+)?$",
             )
             items = lib.items(work_query)
             self._log.debug(f"found {len(items)} items for work query: {*work_query,}")
-            self.msg(f"found {len(items)} item(s) matching the work")
+            self.detail(f"found {len(items)} item(s) matching the work")
             for item in items:
-                updated += self.process_item(item, res)
+                updated += self.process_item(item, data)
         return updated
 
+    def new_progress(self, total, action):
+        return Progress(
+            total, action, self.options.messages and not self.options.detailed
+        )
+
+    def open_queue(self):
+        if not self.options.queue:
+            raise UserError(f"{self.name}: worker mode requires a queue")
+        return WorkQueue(
+            self.options.queue, self.options.queue_lease, self.options.queue_attempts
+        )
+
+    def apply_queue(self, lib, works):
+        updated = 0
+        pending = 0
+        with self.open_queue() as queue:
+            if not self.options.pretend:
+                queue.publish(
+                    (work_key(work) for work in works),
+                    retry_failed=self.options.force,
+                )
+            for work in works:
+                (state, res) = queue.result(work_key(work))
+                work_updated = 0
+                if state == WorkQueue.DONE:
+                    self.detail(
+                        f'\nprocess work: {work[0]}:"{work[1]}", work:"{work[2]}"',
+                    )
+                    work_updated = self.apply_work(lib, work, res)
+                elif state != WorkQueue.FAILED:
+                    pending += 1
+                self.progress.advance(work_updated)
+                updated += work_updated
+        self.msg(f"{pending} work(s) pending on queue")
+        return updated
+
+    def run_worker(self):
+        progress = self.new_progress(0, "work(s) found")
+        with self.open_queue() as queue:
+            while (key := queue.lease()) is not None:
+                progress.total = progress.processed + 1 + queue.pending()
+                self.detail(f'\nresolve work: "{key[0]}", work:"{key[1]}"')
+                try:
+                    res = self.find_data(f"{key[0]} {key[1]}")
+                except Exception:
+                    queue.abandon(key)
+                    raise
+                except BaseException:
+                    queue.release(key)
+                    raise
+                if self.custom_search_exhausted():
+                    queue.release(key)
+                    self.msg("all google custom search services exhausted")
+                    break
+                if not self.options.interactive and self.cs_last_status != 200:
+                    queue.release(key)
+                    self.msg(
+                        f"google custom search error, status code: {self.cs_last_status}"
+                    )
+                    break
+                found = 1 if res and res[WORK_STYLE] else 0
+                if not queue.complete(key, res if found else None):
+                    self._log.debug(f"lease expired, result discarded: {key}")
+                progress.advance(found)
+        if not self.options.interactive:
+            self.msg(f"{self.cs_call_count} google custom search call(s) executed")
+        self.msg(f"{progress.processed} work(s) resolved, {progress.updated} found")
+
+    def custom_search_exhausted(self):
+        return (
+            not self.options.interactive
+            and len(self.cs_last_call) > 0
+            and all(status_code == 429 for status_code in self.cs_last_call)
+        )
+
     def manual_search(self, items):
         updated = 0
-        res = self.find_data(self.config["search"].as_str())
+        res = self.find_data(self.options.search)
         if res and res[WORK_STYLE]:
+            data = work_data(res, self.options)
             for item in items:
-                updated += self.process_item(item, res)
+                updated += self.process_item(item, data)
+        self.progress.advance(updated)
         return updated
 
-    def process_item(self, item, res):
+    def process_item(self, item, data):
         updated = 0
-        apply = self.config["force"].get(False) or not item.get(WORK_STYLE)
+        o = self.options
+        apply = o.force or not item.get(WORK_STYLE)
         if apply:
-            if not self.config["pretend"].get(False):
-                self.modify_item(item, res)
-            self.print_result(item, res)
+            if not o.pretend:
+                self.modify_item(item, data)
+            if o.detailed:
+                self.print_result(item, data)
             updated = 1
         return updated
 
-    def modify_item(self, item, res):
-        f = self.config["fields"]
-        item[WORK_STYLE] = res[WORK_STYLE]
-        if f[FIRST_PUBLICATION].get(False):
-            item[FIRST_PUBLICATION] = res[FIRST_PUBLICATION]
-        if f[GENRE_CATEGORIES].get(False):
-            item[GENRE_CATEGORIES] = "; ".join(res[GENRE_CATEGORIES])
-        if f[GENRE].get(False):
-            item[GENRE] = calc_genre(res)
-        if self.config["write"].get(config["import"]["write"].get(True)):
+    def modify_item(self, item, data):
+        o = self.options
+        item[WORK_STYLE] = data.work_style
+        if o.first_publication:
+            item[FIRST_PUBLICATION] = data.first_publication
+        if o.genre_categories:
+            item[GENRE_CATEGORIES] = data.genre_categories
+        if o.genre:
+            item[GENRE] = data.genre
+        if o.write:
             item.try_sync(True, False)
         else:
             item.store()
 
     def find_data(self, query):
-        if self.config["interactive"].get(False):
+        if self.options.interactive:
             search = "https://www.google.com/search?" + urllib.parse.urlencode(
                 {"q": "site:imslp.org " + query}
             )
@@ -267,42 +394,160 @@ class ScribePlugin(BeetsPlugin):
             cs_actives = [i for i in range(cs_list_len) if self.cs_last_call[i] != 429]
             cs_actives_len = len(cs_actives)
         self.cs_call_count += retries
+        self.cs_last_status = status_code
         return res[0] if res else ""
 
-    def print_result(self, item, res):
-        f = self.config["fields"]
-        data = ", ".join(
-            filter(
-                None,
-                (
-                    fmt(WORK_STYLE, res[WORK_STYLE], True, 30, True),
-                    fmt(GENRE, calc_genre(res), f[GENRE].get(False), 40, True),
-                    fmt(
-                        FIRST_PUBLICATION,
-                        res[FIRST_PUBLICATION],
-                        f[FIRST_PUBLICATION].get(False),
-                        20,
-                        True,
-                    ),
-                    fmt(
-                        GENRE_CATEGORIES,
-                        str(res[GENRE_CATEGORIES]),
-                        f[GENRE_CATEGORIES].get(False),
-                        60,
-                        False,
-                    ),
-                ),
-            )
-        )
+    def print_result(self, item, data):
         self.msg(
-            f"{self.config['action'].as_str().capitalize()}: {item.artist} - {item.album} - {item.title}\n{data}",
+            f"{self.options.action.capitalize()}: {item.artist} - {item.album} - {item.title}\n{data.summary}",
         )
 
     def msg(self, message):
-        if not self.config["quiet"].get(False) or self.config["interactive"].get(False):
+        if self.options.messages:
+            print_(message)
+
+    def detail(self, message):
+        if self.options.detailed:
             print_(message)
 
 
+@dataclass(frozen=True, slots=True)
+class RunOptions:
+    """Options of a single run, resolved once from the plugin configuration."""
+
+    explain: bool
+    force: bool
+    pretend: bool
+    quiet: bool
+    verbose: bool
+    interactive: bool
+    list_works: bool
+    search: str
+    queue: str
+    queue_lease: int
+    queue_attempts: int
+    worker: bool
+    genre: bool
+    genre_categories: bool
+    first_publication: bool
+    write: bool
+    action: str
+    messages: bool
+    detailed: bool
+
+
+def run_options(cfg):
+    f = cfg["fields"]
+    pretend = cfg["pretend"].get(False)
+    quiet = cfg["quiet"].get(False)
+    verbose = cfg["verbose"].get(False)
+    interactive = cfg["interactive"].get(False)
+    messages = not quiet or interactive
+    return RunOptions(
+        explain=cfg["explain"].get(False),
+        force=cfg["force"].get(False),
+        pretend=pretend,
+        quiet=quiet,
+        verbose=verbose,
+        interactive=interactive,
+        list_works=cfg["list_works"].get(False),
+        search=cfg["search"].get(""),
+        queue=cfg["queue"].as_filename() if cfg["queue"].get("") else "",
+        queue_lease=cfg["queue_lease"].get(600),
+        queue_attempts=cfg["queue_attempts"].get(3),
+        worker=cfg["worker"].get(False),
+        genre=f[GENRE].get(False),
+        genre_categories=f[GENRE_CATEGORIES].get(False),
+        first_publication=f[FIRST_PUBLICATION].get(False),
+        write=cfg["write"].get(config["import"]["write"].get(True)),
+        action="potentially updated" if pretend else "updated",
+        messages=messages,
+        detailed=messages and (verbose or interactive),
+    )
+
+
+@dataclass(frozen=True, slots=True)
+class WorkData:
+    """Values collected for a work, formatted once and applied to all its items."""
+
+    work_style: str
+    first_publication: str
+    genre_categories: str
+    genre: str
+    summary: str
+
+
+def work_data(res, options):
+    genre = calc_genre(res)
+    summary = ", ".join(
+        filter(
+            None,
+            (
+                fmt(WORK_STYLE, res[WORK_STYLE], True, 30, True),
+                fmt(GENRE, genre, options.genre, 40, True),
+                fmt(
+                    FIRST_PUBLICATION,
+                    res[FIRST_PUBLICATION],
+                    options.first_publication,
+                    20,
+                    True,
+                ),
+                fmt(
+                    GENRE_CATEGORIES,
+                    str(res[GENRE_CATEGORIES]),
+                    options.genre_categories,
+                    60,
+                    False,
+                ),
+            ),
+        )
+    )
+    return WorkData(
+        res[WORK_STYLE],
+        res[FIRST_PUBLICATION],
+        "; ".join(res[GENRE_CATEGORIES]),
+        genre,
+        summary,
+    )
+
+
+class Progress:
+    """Progress of the works processed, reported at most once per interval."""
+
+    def __init__(self, total, action, enabled=True, interval=2.0):
+        self.total = total
+        self.action = action
+        self.enabled = enabled
+        self.interval = interval
+        self.processed = 0
+        self.updated = 0
+        self.start = self.last = time.monotonic()
+
+    def advance(self, updated):
+        self.processed += 1
+        self.updated += updated
+        if self.enabled:
+            now = time.monotonic()
+            if now - self.last >= self.interval:
+                self.last = now
+                print_(self.status(now))
+
+    def status(self, now):
+        elapsed = now - self.start
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.processed
+        eta = (
+            f", ETA {format_duration(remaining / rate)}" if rate and remaining else ""
+        )
+        return f"processed {self.processed}/{self.total} work(s), {self.updated} {self.action}, {rate:.1f} work(s)/s{eta}"
+
+
+def format_duration(seconds):
+    (minutes, seconds) = divmod(round(seconds), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
 def map_work(item):
     (author_field, author) = (
         ("composer_sort", item["composer_sort"])
@@ -317,6 +562,135 @@ def map_work(item):
     )
 
 
+def work_key(work):
+    return (work[1], work[2])
+
+
+class WorkQueue:
+    """Work queue stored in a SQLite file, shared among libraries and workers.
+
+    Each pair (composer, work) is published once; workers lease the pending
+    pairs for a limited time, resolve them and publish the results, which are
+    then applied by each library.
+    """
+
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path, lease_time=600, max_attempts=3):
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS works (
+                author TEXT NOT NULL,
+                work TEXT NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                result TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (author, work)
+            )"""
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def publish(self, keys, retry_failed=False):
+        keys = list(keys)
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO works (author, work, state) VALUES (?, ?, ?)",
+                ((author, work, self.PENDING) for (author, work) in keys),
+            )
+            if retry_failed:
+                self.conn.executemany(
+                    "UPDATE works SET state = ?, attempts = 0 WHERE author = ? AND work = ? AND state = ?",
+                    (
+                        (self.PENDING, author, work, self.FAILED)
+                        for (author, work) in keys
+                    ),
+                )
+
+    def lease(self):
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT author, work FROM works WHERE state = ? OR (state = ? AND lease_until < ?) LIMIT 1",
+                (self.PENDING, self.LEASED, now),
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE works SET state = ?, worker = ?, lease_until = ? WHERE author = ? AND work = ?",
+                    (self.LEASED, self.worker, now + self.lease_time, *row),
+                )
+        return row
+
+    def release(self, key):
+        return self._update(key, self.PENDING, None)
+
+    def complete(self, key, res):
+        if res:
+            return self._update(key, self.DONE, json.dumps(res))
+        else:
+            return self._update(key, self.FAILED, None)
+
+    def abandon(self, key):
+        # the lookup raised an error: the pair is released to be retried and
+        # marked as failed once it reaches the maximum number of attempts
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            cursor = self.conn.execute(
+                "UPDATE works SET state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END, attempts = attempts + 1, worker = NULL, lease_until = NULL WHERE author = ? AND work = ? AND state = ? AND worker = ?",
+                (
+                    self.max_attempts,
+                    self.FAILED,
+                    self.PENDING,
+                    *key,
+                    self.LEASED,
+                    self.worker,
+                ),
+            )
+        return cursor.rowcount > 0
+
+    def pending(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM works WHERE state = ? OR (state = ? AND lease_until < ?)",
+            (self.PENDING, self.LEASED, time.time()),
+        ).fetchone()[0]
+
+    def result(self, key):
+        row = self.conn.execute(
+            "SELECT state, result FROM works WHERE author = ? AND work = ?", key
+        ).fetchone()
+        if row is None:
+            return (None, None)
+        return (row[0], json.loads(row[1]) if row[1] else None)
+
+    def _update(self, key, state, result):
+        # the update is applied only while the caller still owns the lease,
+        # a worker whose lease expired and was taken by another one is ignored
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            cursor = self.conn.execute(
+                "UPDATE works SET state = ?, result = ?, worker = NULL, lease_until = NULL WHERE author = ? AND work = ? AND state = ? AND worker = ?",
+                (state, result, *key, self.LEASED, self.worker),
+            )
+        return cursor.rowcount > 0
+
+
 def google_search(_log, query, api_key, cse_id, num_results=5):
     url = "https://www.googleapis.com/customsearch/v1"
     params = {
@@ -467,6 +841,16 @@ queries/day.
 
 The option [22m[23m[31m[47m[24m[29m -l / --list [0m produce the list of the distinct pairs
 (composer, work) identified from the collected items.
+
+During the activity a progress report is periodically showed; the option
+[22m[23m[31m[47m[24m[29m -v / --verbose [0m shows instead the details for each work and item
+processed.
+
+The option [22m[23m[31m[47m[24m[29m -Q / --queue [0m shares the lookups among several libraries
+through a work queue stored in a SQLite file: the pairs (composer, work)
+are published to the queue and only the results already available are
+applied to the items. The pairs are resolved by one or more processes
+started with [22m[23m[31m[47m[24m[29m -w / --worker [0m, using the same queue.
         '''
     )
 
@@ -1,7 +1,12 @@
 import json
 import logging
+import os
 from unittest.mock import patch
 import pytest
+import requests
+from beets import config
+from beets.library import Item, Library
+from beets.ui import UserError
 
 from context import beetsplug
 from beetsplug import scribe
@@ -15,6 +20,61 @@ def mock_response():
         yield mock_get
 
 
+@pytest.fixture
+def cfg():
+    config.clear()
+    config.read(user=False)
+    yield config["scribe"]
+    config.clear()
+
+
+@pytest.fixture
+def plugin(cfg):
+    cfg["write"] = False
+    cfg["custom_search"] = [{"api_key": "XXX", "cse_id": "123"}]
+    yield scribe.ScribePlugin()
+
+
+@pytest.fixture
+def lib(tmp_path):
+    lib = Library(str(tmp_path / "library.db"))
+    for title in ("I. Allegro assai", "II. Andante con moto"):
+        lib.add(
+            Item(
+                title=title,
+                artist="Beethoven",
+                artist_sort="Beethoven, Ludwig van",
+                work=f"Piano Sonata No.23: {title}",
+                album="Piano Sonatas",
+            )
+        )
+    lib.add(Item(title="Für Elise", artist="Beethoven", album="Bagatelles"))
+    lib.add(
+        Item(
+            title="La Bataille",
+            artist="Mozart",
+            artist_sort="Mozart, Wolfgang Amadeus",
+            work="La Bataille",
+            album="Contredanses",
+        )
+    )
+    yield lib
+    lib._close()
+
+
+def run_command(plugin, lib, *args):
+    command = plugin.commands()[0]
+    (opts, args) = command.parser.parse_args(list(args))
+    command.func(lib, opts, args)
+
+
+SONATA_23 = {
+    "sc_genre_categories": ["Sonatas", "For piano"],
+    "sc_first_publication": "1807",
+    "sc_work_style": "Classical",
+}
+
+
 def test_google_search_ok(mock_response):
     with open(
         "tests/data/google_ok_resp.json",
@@ -143,3 +203,213 @@ def test_strip_repeated_elements():
         )
         == "Rossini, Gioachino"
     )
+
+
+def test_work_queue_lease(tmp_path):
+    path = tmp_path / "queue.db"
+    with scribe.WorkQueue(path) as publisher:
+        publisher.publish(
+            [("Beethoven", "Piano Sonata No.23"), ("Mozart", "La Bataille")]
+        )
+        publisher.publish([("Beethoven", "Piano Sonata No.23")])
+        with scribe.WorkQueue(path) as w1, scribe.WorkQueue(path) as w2:
+            k1 = w1.lease()
+            k2 = w2.lease()
+            assert {k1, k2} == {
+                ("Beethoven", "Piano Sonata No.23"),
+                ("Mozart", "La Bataille"),
+            }
+            assert w1.lease() is None
+            res = {
+                "sc_genre_categories": ["Sonatas"],
+                "sc_first_publication": "1807",
+                "sc_work_style": "Classical",
+            }
+            w1.complete(k1, res)
+            w2.complete(k2, None)
+        assert publisher.result(k1) == (scribe.WorkQueue.DONE, res)
+        assert publisher.result(k2) == (scribe.WorkQueue.FAILED, None)
+        assert publisher.result(("Bach", "Mass in B minor")) == (None, None)
+
+
+def test_work_queue_expired_lease(tmp_path):
+    path = tmp_path / "queue.db"
+    with scribe.WorkQueue(path, lease_time=-1) as w1, scribe.WorkQueue(path) as w2:
+        w1.publish([("Beethoven", "Piano Sonata No.23")])
+        key = w1.lease()
+        assert w1.result(key) == (scribe.WorkQueue.LEASED, None)
+        assert w2.lease() == key
+        assert w2.lease() is None
+        w2.release(key)
+        assert w2.result(key) == (scribe.WorkQueue.PENDING, None)
+
+
+def test_run_options(cfg):
+    config["import"]["write"] = False
+    cfg.set(
+        {
+            "pretend": True,
+            "quiet": True,
+            "queue": "~/queue.db",
+            "fields": {"genre": True},
+        }
+    )
+    options = scribe.run_options(cfg)
+    assert options.write is False
+    assert options.action == "potentially updated"
+    assert (options.genre, options.first_publication) == (True, False)
+    assert options.queue == os.path.expanduser("~/queue.db")
+    assert (options.messages, options.detailed) == (False, False)
+
+    cfg["write"] = True
+    cfg["interactive"] = True
+    options = scribe.run_options(cfg)
+    assert options.write is True
+    assert (options.messages, options.detailed) == (True, True)
+
+    cfg["interactive"] = False
+    cfg["quiet"] = False
+    options = scribe.run_options(cfg)
+    assert (options.messages, options.detailed) == (True, False)
+
+    cfg["verbose"] = True
+    options = scribe.run_options(cfg)
+    assert (options.messages, options.detailed) == (True, True)
+
+
+def test_work_data(cfg):
+    cfg["fields"] = {"genre": True, "sc_genre_categories": True}
+    data = scribe.work_data(SONATA_23, scribe.run_options(cfg))
+    assert data == scribe.WorkData(
+        "Classical",
+        "1807",
+        "Sonatas; For piano",
+        "Classical; Sonatas",
+        "sc_work_style = \"Classical\", genre = \"Classical; Sonatas\", sc_genre_categories = ['Sonatas', 'For piano']",
+    )
+
+
+def test_progress_status():
+    progress = scribe.Progress(100, "item(s) updated", enabled=False)
+    for updated in (1, 0, 1, 1):
+        progress.advance(updated)
+    assert (
+        progress.status(progress.start + 2)
+        == "processed 4/100 work(s), 3 item(s) updated, 2.0 work(s)/s, ETA 0:00:48"
+    )
+    assert scribe.format_duration(3725) == "1:02:05"
+
+
+def test_work_queue_stale_lease(tmp_path):
+    path = tmp_path / "queue.db"
+    with scribe.WorkQueue(path, lease_time=-1) as w1, scribe.WorkQueue(path) as w2:
+        w1.publish([("Beethoven", "Piano Sonata No.23")])
+        key = w1.lease()
+        assert w2.lease() == key
+        assert w2.complete(key, SONATA_23)
+        assert not w1.release(key)
+        assert not w1.complete(key, None)
+        assert w2.result(key) == (scribe.WorkQueue.DONE, SONATA_23)
+
+
+def test_work_queue_retry_failed(tmp_path):
+    with scribe.WorkQueue(tmp_path / "queue.db") as queue:
+        queue.publish([("Beethoven", "Piano Sonata No.23")])
+        key = queue.lease()
+        queue.complete(key, None)
+        queue.publish([key])
+        assert queue.result(key) == (scribe.WorkQueue.FAILED, None)
+        queue.publish([key], retry_failed=True)
+        assert queue.result(key) == (scribe.WorkQueue.PENDING, None)
+
+
+def test_worker_lookup_error(plugin, lib, tmp_path):
+    path = tmp_path / "queue.db"
+    key = ("Beethoven", "Piano Sonata No.23")
+    with scribe.WorkQueue(path) as queue:
+        queue.publish([key])
+    error = requests.ConnectionError("connection refused")
+    with patch.object(plugin, "find_data", side_effect=error):
+        for state in (scribe.WorkQueue.PENDING,) * 2 + (scribe.WorkQueue.FAILED,):
+            with pytest.raises(requests.ConnectionError):
+                run_command(plugin, lib, "-Q", str(path), "-w")
+            with scribe.WorkQueue(path) as queue:
+                assert queue.result(key) == (state, None)
+    with scribe.WorkQueue(path) as queue:
+        queue.publish([key], retry_failed=True)
+        assert queue.result(key) == (scribe.WorkQueue.PENDING, None)
+        queue.lease()
+        assert queue.abandon(key)
+        assert queue.result(key) == (scribe.WorkQueue.PENDING, None)
+
+
+def test_worker_custom_search_exhausted(plugin, lib, tmp_path, mock_response):
+    path = tmp_path / "queue.db"
+    with scribe.WorkQueue(path) as queue:
+        queue.publish(
+            [("Beethoven", "Piano Sonata No.23"), ("Mozart", "La Bataille")]
+        )
+    mock_response.return_value.status_code = 429
+    mock_response.return_value.json.return_value = {}
+
+    run_command(plugin, lib, "-Q", str(path), "-w")
+
+    mock_response.assert_called_once()
+    with scribe.WorkQueue(path) as queue:
+        assert queue.result(("Beethoven", "Piano Sonata No.23")) == (
+            scribe.WorkQueue.PENDING,
+            None,
+        )
+        assert queue.result(("Mozart", "La Bataille")) == (
+            scribe.WorkQueue.PENDING,
+            None,
+        )
+
+
+def test_worker_and_apply_queue(plugin, lib, tmp_path, capsys):
+    path = str(tmp_path / "queue.db")
+    run_command(plugin, lib, "-Q", path, "-p")
+    with scribe.WorkQueue(path) as queue:
+        assert queue.pending() == 0
+    with pytest.raises(UserError):
+        run_command(plugin, lib, "-Q", path, "-s", "beethoven op. 57")
+    # command line options are layered on the same configuration for each run
+    config["scribe"]["pretend"] = False
+    config["scribe"]["search"] = ""
+    run_command(plugin, lib, "-Q", path)
+    out = capsys.readouterr().out
+    assert "2 work(s) pending on queue" in out
+    assert "1 item(s) discarded, empty work field" in out
+    assert "Für Elise" not in out
+    assert all(not item.get(scribe.WORK_STYLE) for item in lib.items())
+
+    def find_data(query):
+        return SONATA_23 if query.startswith("Beethoven") else None
+
+    with patch.object(plugin, "find_data", side_effect=find_data):
+        run_command(plugin, lib, "-Q", path, "-w")
+    out = capsys.readouterr().out
+    assert "2 work(s) resolved, 1 found" in out
+    assert "resolve work" not in out
+    with scribe.WorkQueue(path) as queue:
+        assert queue.result(("Beethoven, Ludwig van", "Piano Sonata No.23")) == (
+            scribe.WorkQueue.DONE,
+            SONATA_23,
+        )
+        assert queue.result(("Mozart, Wolfgang Amadeus", "La Bataille")) == (
+            scribe.WorkQueue.FAILED,
+            None,
+        )
+
+    config["scribe"]["worker"] = False
+    with patch.object(plugin, "find_data", side_effect=AssertionError):
+        run_command(plugin, lib, "-Q", path)
+    assert "0 work(s) pending on queue" in capsys.readouterr().out
+    assert (plugin.progress.processed, plugin.progress.total) == (2, 2)
+    assert plugin.progress.updated == 2
+    assert {item.title: item.get(scribe.WORK_STYLE) for item in lib.items()} == {
+        "I. Allegro assai": "Classical",
+        "II. Andante con moto": "Classical",
+        "La Bataille": None,
+        "Für Elise": None,
+    }